@@ -2,36 +2,180 @@
 #!/usr/bin/env python3
 
 import imaplib
-import email
 import re
 import time
 import json
 import os
+import random
 from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 import threading
-from email.header import decode_header
+from email.parser import BytesParser
+from email.policy import default as default_policy
 import hashlib
+import selectors
+import socket
+import ssl
 import sqlite3
+import queue
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
 import logging
+from collections import OrderedDict
+
+# orjson parses Telegram replies about twice as fast when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Bot API endpoint. Point this at a self-hosted telegram-bot-api server (--local),
+# ideally in the same region as the bot, to cut the round trip of every send
+TG_API_BASE = os.environ.get("TG_API_BASE", "https://api.telegram.org").rstrip("/")
 
 # Configuration
 CONFIG_DIR = "bot_data"
 DB_FILE = "bot_users.db"
-MAX_WORKERS = 1000  # Support for 1000+ concurrent users
+MAX_WORKERS = min(32, (os.cpu_count() or 4) * 4)  # Short IMAP/DB tasks only; idling users hold no thread
+MAX_CONCURRENT_LOGINS = 8  # Avoid stampeding Gmail with logins on cold start
+THREAD_STACK_SIZE = 512 * 1024  # Worker threads do I/O, scrypt and MIME parsing; 8MB stacks are wasted
+READ_POOL_SIZE = 8  # Pooled read-only connections; writes share one connection
+PROCESSED_EMAILS_LIMIT = 200  # Per-user UIDs remembered to avoid forwarding twice
+LONG_POLL_TIMEOUT = 50  # Seconds Telegram holds getUpdates open when idle
+UPDATES_LIMIT = 100  # Many users share one getUpdates stream, so take full batches
+RECONNECT_DELAY = 2  # Seconds before reopening a dropped IMAP session
+LOG_FLUSH_INTERVAL = 0.2  # Seconds to collect OTP log rows into one transaction
 LOG_FILE = "bot.log"
+IMAP_HOST = "imap.gmail.com"
+IDLE_TIMEOUT = 25 * 60  # Gmail drops IDLE sessions after ~29 minutes
+IMAP_TIMEOUT = 30  # Seconds a blocking IMAP read may stall before the session is dropped
+IDLE_EXISTS_RE = re.compile(rb'^\* \d+ EXISTS')
+UIDNEXT_RE = re.compile(rb'UIDNEXT (\d+)')
+OTP_RE = re.compile(
+    r'(?:code|verification|otp|pin|token|confirm|authenticate|security)[:\s-]*(\d{4,8})|\b(\d{4,8})\b',
+    re.IGNORECASE
+)
+FROM_RE = re.compile(r'^([^<]*)<([^>]+)>')
+# Markup stripped from HTML-only bodies: style/script blocks (even if truncated), tags and #hex colours
+HTML_NOISE_RE = re.compile(r'<(style|script)\b.*?(?:</\1\s*>|$)|<[^>]+>|#[0-9a-f]{3,8}\b', re.IGNORECASE | re.DOTALL)
+USERS_COLUMNS = """
+    chat_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    email TEXT NOT NULL,
+    password_hash TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    total_otps INTEGER DEFAULT 0,
+    is_active INTEGER DEFAULT 1,
+    subscription_type TEXT DEFAULT 'free'
+"""
+
+# Hot-path statements, kept as constants so each connection's statement cache reuses them
+SQL_SAVE_USER = """
+    INSERT INTO users
+    (chat_id, username, first_name, email, password_hash, last_active)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        email = excluded.email,
+        password_hash = excluded.password_hash,
+        last_active = excluded.last_active,
+        is_active = 1
+"""
+SQL_STORE_PASSWORD_HASH = "UPDATE users SET password_hash = ? WHERE chat_id = ?"
+SQL_DEACTIVATE_USER = "UPDATE users SET is_active = 0 WHERE chat_id = ?"
+SQL_LOAD_USERS = """
+    SELECT chat_id, email, username, total_otps, last_active
+    FROM users WHERE is_active = 1
+"""
+SQL_INSERT_OTP_LOG = """
+    INSERT INTO otp_logs
+    (chat_id, sender_email, sender_name, otp_code, subject, detection_time_ms)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+SQL_COUNT_OTP = """
+    UPDATE users SET total_otps = total_otps + 1, last_active = ?
+    WHERE chat_id = ?
+"""
+SQL_USER_STATS = """
+    SELECT total_otps, created_at, last_active
+    FROM users WHERE chat_id = ?
+"""
+SQL_TODAY_OTPS = """
+    SELECT COUNT(*) FROM otp_logs
+    WHERE chat_id = ? AND forwarded_at >= date('now', 'start of day')
+"""
+SQL_RECENT_OTPS = """
+    SELECT sender_name, otp_code, forwarded_at
+    FROM otp_logs WHERE chat_id = ?
+    ORDER BY forwarded_at DESC LIMIT 5
+"""
+MESSAGE_PARSER = BytesParser(policy=default_policy)
+FETCH_HEADERS = '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING)])'
+FETCH_TEXT = '(BODY.PEEK[TEXT])'
+
+# OTP notification wording, picked at random per message for a natural feel
+TITLE_VARIATIONS = (
+    "🚀 New OTP Code!",
+    "⚡ Fresh OTP Code!",
+    "🔥 New Code Arrived!",
+    "✨ OTP Code Ready!",
+    "💫 New Verification Code!"
+)
+
+HELP_VARIATIONS = (
+    "If you need help? contact me @Astro0_0o",
+    "Need assistance? reach me @Astro0_0o",
+    "Having issues? contact @Astro0_0o",
+    "For support contact @Astro0_0o",
+    "Questions? message @Astro0_0o",
+    "Need help? DM @Astro0_0o"
+)
+
+# Clean and professional OTP message format with full bold formatting
+OTP_MESSAGE_TEMPLATE = """<b>{title}</b>
+
+<b>📧 From: {sender_name}</b>
+<b>📝 Subject: {subject}</b>
+<b>⏰ Time: {time}</b>
+<b>🔢 Code:</b> <code>{otp}</code>
+
+<b><i>{help}</i></b>"""
+
+# One TLS context for every IMAP connection so session tickets can be reused
+IMAP_SSL_CONTEXT = ssl.create_default_context()
+
+class ResumableIMAP4_SSL(imaplib.IMAP4_SSL):
+    """IMAP4_SSL that resumes a previous TLS session instead of a full handshake"""
+    
+    def __init__(self, host, tls_session=None):
+        self.tls_session = tls_session
+        super().__init__(host, ssl_context=IMAP_SSL_CONTEXT, timeout=IMAP_TIMEOUT)
+    
+    def _create_socket(self, timeout):
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
 
 class ProfessionalMultiUserOTPBot:
     def __init__(self, bot_token):
         self.bot_token = bot_token
-        self.base_url = f"https://api.telegram.org/bot{bot_token}"
+        self.base_url = f"{TG_API_BASE}/bot{bot_token}"
+        
+        # Shared keep-alive connections to the Telegram API
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=512, max_retries=0)
+        self.session.mount("https://", adapter)
         
         # Multi-user storage
         self.users = {}  # {chat_id: user_config}
-        self.monitoring_threads = {}  # {chat_id: thread}
+        self.idle_sessions = {}  # {id(user_config): (chat_id, user_config)} for sockets registered with the poller
+        self.reconnect_due = {}  # {chat_id: (timestamp, user_config)}
         self.waiting_states = {}  # {chat_id: state}
         self.temp_credentials = {}  # {chat_id: {email, password}}
+        self.login_tests = set()  # chat_ids whose credentials are being tested on the executor
         self.user_stats = {}  # {chat_id: stats}
         
         # Bot management
@@ -40,13 +184,23 @@ class ProfessionalMultiUserOTPBot:
         
         # Thread management for unlimited users
         self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-        self.gmail_locks = {}  # Per-user locks to prevent conflicts
+        self.login_slots = threading.Semaphore(MAX_CONCURRENT_LOGINS)
+        self.idle_selector = selectors.DefaultSelector()
+        self.idle_lock = threading.Lock()  # Guards hand-off of sessions out of idle_sessions
+        self.monitoring_lock = threading.Lock()  # Makes the is_monitoring check-and-set atomic
         
         # Initialize everything
         self.setup_logging()
         self.init_storage()
         self.load_all_users()
         
+        # OTP logs and password hashes are written in batches off the request path
+        self.write_queue = queue.Queue()  # (sql, params) pairs
+        threading.Thread(target=self.batch_writer, daemon=True, name="DB-Batch-Writer").start()
+        
+        # One thread waits on every user's IDLE socket
+        threading.Thread(target=self.idle_poller, daemon=True, name="IMAP-IDLE-Poller").start()
+        
         print("🚀 Professional Multi-User Gmail OTP Bot Started!")
         print(f"📊 Supporting 1000+ concurrent users with {MAX_WORKERS} workers")
         print(f"🎯 Ultra-optimized for high-volume traffic")
@@ -66,26 +220,38 @@ class ProfessionalMultiUserOTPBot:
         )
         self.logger = logging.getLogger(__name__)
         
+    def open_db_connection(self):
+        """Open a thread-shareable SQLite connection tuned for concurrent access"""
+        conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE), check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-32768")
+        return conn
+    
+    @contextmanager
+    def read_connection(self):
+        """Borrow a pooled read connection"""
+        conn = self.read_pool.get()
+        try:
+            yield conn
+        finally:
+            self.read_pool.put(conn)
+    
     def init_storage(self):
-        """Initialize professional database schema"""
-        conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE))
+        """Initialize professional database schema and connection pool"""
+        # Single writer connection; WAL lets pooled readers run alongside it
+        self.write_conn = self.open_db_connection()
+        self.write_conn.execute("PRAGMA page_size=8192")  # Only applies to a new database
+        self.write_conn.execute("PRAGMA journal_mode=WAL")
+        self.write_conn_lock = threading.Lock()
+        
+        conn = self.write_conn
         cursor = conn.cursor()
         
         # Users table with more details
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                chat_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                email TEXT NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_otps INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1,
-                subscription_type TEXT DEFAULT 'free'
-            )
-        """)
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS users ({USERS_COLUMNS})")
+        self.migrate_users_table(cursor)
         
         # OTP logs with more tracking
         cursor.execute("""
@@ -101,6 +267,10 @@ class ProfessionalMultiUserOTPBot:
                 FOREIGN KEY (chat_id) REFERENCES users (chat_id)
             )
         """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_otp_logs_chat_date
+            ON otp_logs (chat_id, forwarded_at DESC)
+        """)
         
         # System stats
         cursor.execute("""
@@ -114,38 +284,52 @@ class ProfessionalMultiUserOTPBot:
         """)
         
         conn.commit()
-        conn.close()
+        
+        self.read_pool = queue.Queue()
+        for _ in range(READ_POOL_SIZE):
+            self.read_pool.put(self.open_db_connection())
+        
         self.logger.info("Database initialized successfully")
     
+    def migrate_users_table(self, cursor):
+        """Rebuild users tables created when password_hash was NOT NULL"""
+        not_null = {row[1]: row[3] for row in cursor.execute("PRAGMA table_info(users)")}
+        if not not_null.get("password_hash"):
+            return
+        
+        cursor.execute(f"CREATE TABLE users_migrated ({USERS_COLUMNS})")
+        cursor.execute("INSERT INTO users_migrated SELECT * FROM users")
+        cursor.execute("DROP TABLE users")
+        cursor.execute("ALTER TABLE users_migrated RENAME TO users")
+        self.logger.info("Migrated users table: password_hash is now nullable")
+    
     def save_user(self, chat_id, email, password, user_info=None):
         """Save user with professional data handling"""
         try:
-            conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE))
-            cursor = conn.cursor()
-            
-            # Hash password securely
-            password_hash = hashlib.sha256(f"{password}_{chat_id}".encode()).hexdigest()
-            
             username = user_info.get('username', '') if user_info else ''
             first_name = user_info.get('first_name', '') if user_info else ''
             
-            cursor.execute("""
-                INSERT OR REPLACE INTO users 
-                (chat_id, username, first_name, email, password_hash, last_active) 
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (chat_id, username, first_name, email, password_hash, datetime.now()))
+            with self.write_conn_lock, self.write_conn:
+                self.write_conn.execute(SQL_SAVE_USER, (chat_id, username, first_name, email, None, datetime.now()))
+            
+            # Hash password securely, off the login path
+            self.executor.submit(self.hash_and_store_password, chat_id, password)
             
-            conn.commit()
-            conn.close()
+            # A previous login's session must not keep forwarding alongside the new one
+            if chat_id in self.users:
+                self.stop_monitoring_for_user(chat_id)
             
             # Store in memory for active monitoring
             self.users[chat_id] = {
                 "email": email,
                 "password": password,
                 "is_monitoring": False,
-                "last_processed_emails": set(),
-                "last_email_count": 0,
-                "monitor_thread": None
+                "last_processed_emails": OrderedDict(),
+                "uid_next": None,
+                "tls_session": None,
+                "mail": None,
+                "idle_tag": None,
+                "idle_since": 0
             }
             
             # Initialize user stats
@@ -155,9 +339,6 @@ class ProfessionalMultiUserOTPBot:
                 "session_start": datetime.now()
             }
             
-            # Create per-user lock
-            self.gmail_locks[chat_id] = threading.Lock()
-            
             self.logger.info(f"User saved successfully: {email} (Chat ID: {chat_id})")
             return True
             
@@ -165,17 +346,22 @@ class ProfessionalMultiUserOTPBot:
             self.logger.error(f"Error saving user {chat_id}: {e}")
             return False
     
+    def hash_and_store_password(self, chat_id, password):
+        """Store a salted scrypt hash of the password"""
+        try:
+            salt = os.urandom(16)
+            key = hashlib.scrypt(password.encode(), salt=salt, n=16384, r=8, p=1, dklen=32)
+            
+            self.write_queue.put((SQL_STORE_PASSWORD_HASH, (f"{salt.hex()}${key.hex()}", chat_id)))
+            
+        except Exception as e:
+            self.logger.error(f"Error hashing password for {chat_id}: {e}")
+    
     def load_all_users(self):
         """Load all users and resume their monitoring"""
         try:
-            conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE))
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT chat_id, email, username, total_otps, last_active 
-                FROM users WHERE is_active = 1
-            """)
-            users = cursor.fetchall()
-            conn.close()
+            with self.read_connection() as conn:
+                users = conn.execute(SQL_LOAD_USERS).fetchall()
             
             self.logger.info(f"Loading {len(users)} registered users...")
             
@@ -186,7 +372,6 @@ class ProfessionalMultiUserOTPBot:
                     "last_otp_time": None,
                     "session_start": datetime.now()
                 }
-                self.gmail_locks[chat_id] = threading.Lock()
                 
                 self.logger.info(f"Loaded user: {email} ({username}) - {total_otps} OTPs total")
                 
@@ -197,23 +382,14 @@ class ProfessionalMultiUserOTPBot:
         """Professional user deletion"""
         try:
             # Stop monitoring first
-            if chat_id in self.users and self.users[chat_id]["is_monitoring"]:
-                self.users[chat_id]["is_monitoring"] = False
-                
-            # Wait for thread to finish
-            if chat_id in self.monitoring_threads:
-                self.monitoring_threads[chat_id].join(timeout=2)
-                del self.monitoring_threads[chat_id]
+            self.stop_monitoring_for_user(chat_id)
             
             # Database cleanup
-            conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE))
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET is_active = 0 WHERE chat_id = ?", (chat_id,))
-            conn.commit()
-            conn.close()
+            with self.write_conn_lock, self.write_conn:
+                self.write_conn.execute(SQL_DEACTIVATE_USER, (chat_id,))
             
             # Memory cleanup
-            for storage in [self.users, self.user_stats, self.gmail_locks, self.temp_credentials]:
+            for storage in [self.users, self.user_stats, self.temp_credentials]:
                 storage.pop(chat_id, None)
             
             self.logger.info(f"User {chat_id} deleted successfully")
@@ -224,34 +400,45 @@ class ProfessionalMultiUserOTPBot:
             return False
     
     def log_otp(self, chat_id, sender_email, sender_name, otp_code, subject, detection_time_ms):
-        """Professional OTP logging with performance metrics"""
-        try:
-            conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE))
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO otp_logs 
-                (chat_id, sender_email, sender_name, otp_code, subject, detection_time_ms)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (chat_id, sender_email, sender_name, otp_code, subject, detection_time_ms))
-            
-            cursor.execute("""
-                UPDATE users SET total_otps = total_otps + 1, last_active = ?
-                WHERE chat_id = ?
-            """, (datetime.now(), chat_id))
-            
-            conn.commit()
-            conn.close()
+        """Queue an OTP log for the batch writer and update memory stats"""
+        self.write_queue.put((SQL_INSERT_OTP_LOG, (chat_id, sender_email, sender_name, otp_code, subject, detection_time_ms)))
+        self.write_queue.put((SQL_COUNT_OTP, (datetime.now(), chat_id)))
+        
+        # Update memory stats
+        if chat_id in self.user_stats:
+            self.user_stats[chat_id]["total_otps"] += 1
+            self.user_stats[chat_id]["last_otp_time"] = datetime.now()
+        
+        self.logger.info(f"OTP logged for user {chat_id}: {otp_code} in {detection_time_ms}ms")
+    
+    def batch_writer(self):
+        """Persist queued writes, one transaction and one executemany per statement per batch"""
+        while True:
+            writes = [self.write_queue.get()]
             
-            # Update memory stats
-            if chat_id in self.user_stats:
-                self.user_stats[chat_id]["total_otps"] += 1
-                self.user_stats[chat_id]["last_otp_time"] = datetime.now()
+            # Let a burst accumulate, then take everything that is waiting
+            time.sleep(LOG_FLUSH_INTERVAL)
+            while True:
+                try:
+                    writes.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
             
-            self.logger.info(f"OTP logged for user {chat_id}: {otp_code} in {detection_time_ms}ms")
+            # Group by statement, keeping the order in which statements first appeared
+            batches = {}
+            for sql, params in writes:
+                batches.setdefault(sql, []).append(params)
             
-        except Exception as e:
-            self.logger.error(f"Error logging OTP for {chat_id}: {e}")
+            try:
+                with self.write_conn_lock, self.write_conn:
+                    for sql, params in batches.items():
+                        self.write_conn.executemany(sql, params)
+                    
+            except Exception as e:
+                self.logger.error(f"Error writing {len(writes)} queued rows: {e}")
+            finally:
+                for _ in writes:
+                    self.write_queue.task_done()
     
     def send_message(self, chat_id, message, parse_mode="HTML"):
         """Professional message sending with retry logic"""
@@ -265,10 +452,10 @@ class ProfessionalMultiUserOTPBot:
                     "parse_mode": parse_mode,
                     "disable_web_page_preview": True
                 }
-                response = requests.post(url, data=data, timeout=15)
+                response = self.session.post(url, data=data, timeout=15)
                 
                 if response.status_code == 200:
-                    return response.json()
+                    return json_loads(response.content)
                 else:
                     self.logger.warning(f"Message send failed (attempt {attempt + 1}): {response.status_code}")
                     
@@ -281,208 +468,303 @@ class ProfessionalMultiUserOTPBot:
         return None
     
     def get_updates(self):
-        """Professional update handling"""
+        """Long-poll Telegram for new messages"""
         try:
             url = f"{self.base_url}/getUpdates"
-            params = {"offset": self.last_update_id, "timeout": 5}
-            response = requests.get(url, params=params, timeout=15)
+            params = {
+                "offset": self.last_update_id,
+                "timeout": LONG_POLL_TIMEOUT,
+                "limit": UPDATES_LIMIT,
+                "allowed_updates": json.dumps(["message"])
+            }
+            response = self.session.get(url, params=params, timeout=LONG_POLL_TIMEOUT + 10)
             
             if response.status_code == 200:
-                return response.json()
+                return json_loads(response.content)
                 
         except Exception as e:
             self.logger.error(f"Error getting updates: {e}")
         return None
     
     def extract_otp(self, text):
-        """Enhanced OTP extraction with multiple patterns"""
+        """Enhanced OTP extraction with one precompiled pattern"""
         if not text:
             return None
             
-        # Enhanced patterns for better detection
-        patterns = [
-            r'\b(\d{6})\b',  # Most common 6-digit OTP
-            r'\b(\d{4})\b',  # 4-digit codes
-            r'\b(\d{5})\b',  # 5-digit codes  
-            r'\b(\d{8})\b',  # 8-digit codes
-            r'code[:\s-]*(\d{4,8})',
-            r'verification[:\s-]*(\d{4,8})',
-            r'otp[:\s-]*(\d{4,8})',
-            r'pin[:\s-]*(\d{4,8})',
-            r'token[:\s-]*(\d{4,8})',
-            r'confirm[:\s-]*(\d{4,8})',
-            r'authenticate[:\s-]*(\d{4,8})',
-            r'security[:\s-]*(\d{4,8})',
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            for match in matches:
-                code = str(match) if isinstance(match, str) else str(match[0])
-                if 4 <= len(code) <= 8 and code.isdigit():
-                    return code
-        return None
+        # Single pass: stop at the first keyword-prefixed code or standalone 4-8 digit number
+        match = OTP_RE.search(text)
+        return (match.group(1) or match.group(2)) if match else None
     
-    def monitor_gmail_for_user(self, chat_id):
-        """Individual Gmail monitoring for each user - Thread-safe"""
-        if chat_id not in self.users:
-            return
-            
+    def connect_gmail(self, user_config):
+        """Open a logged-in IMAP session with the inbox selected"""
+        with self.login_slots:
+            mail = ResumableIMAP4_SSL(IMAP_HOST, user_config["tls_session"])
+            mail.login(user_config["email"], user_config["password"])
+        mail.select("inbox")
+        
+        # Session tickets arrive after the handshake; keep the latest for reconnects
+        user_config["tls_session"] = mail.sock.session
+        
+        # Only mail arriving after the first connection is forwarded
+        if user_config["uid_next"] is None:
+            user_config["uid_next"] = self.read_uid_next(mail)
+        
+        return mail
+    
+    def read_uid_next(self, mail):
+        """Return the selected inbox's UIDNEXT, failing the connection if it cannot be read"""
+        # SELECT normally reports it as an untagged [UIDNEXT n] response code
+        _, uid_data = mail.response("UIDNEXT")
+        if uid_data and uid_data[0]:
+            return int(uid_data[0])
+        
+        status, status_data = mail.status("INBOX", "(UIDNEXT)")
+        match = UIDNEXT_RE.search(status_data[0]) if status == "OK" and status_data[0] else None
+        if match is None:
+            raise imaplib.IMAP4.error("server did not report UIDNEXT")
+        return int(match.group(1))
+    
+    def read_idle_line(self, mail):
+        """Read one IDLE response line, treating a silent server as a dropped connection"""
+        try:
+            return mail.readline()
+        except socket.timeout:
+            raise imaplib.IMAP4.abort(f"no response from server within {IMAP_TIMEOUT}s")
+    
+    def start_idle(self, mail):
+        """Send IMAP IDLE and return its command tag once the server accepts it"""
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+        response = self.read_idle_line(mail)
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.abort(f"IDLE rejected: {response!r}")
+        return tag
+    
+    def has_buffered_response(self, mail):
+        """Whether a server line can be read without waiting on the socket"""
+        # imaplib reads through a buffered file, so a line that arrived in the same read as
+        # an earlier one never wakes select(); peek without blocking instead
+        timeout = mail.sock.gettimeout()
+        mail.sock.settimeout(0)
+        try:
+            return bool(mail.file.peek(1))
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        finally:
+            mail.sock.settimeout(timeout)
+    
+    def stop_idle(self, mail, tag):
+        """Leave IDLE and report whether the server announced new mail meanwhile"""
+        mail.send(b"DONE\r\n")
+        has_new_mail = False
+        while True:
+            line = self.read_idle_line(mail)
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+            if line.startswith(tag):
+                return has_new_mail
+            if IDLE_EXISTS_RE.match(line):
+                has_new_mail = True
+    
+    def process_new_emails(self, chat_id, mail, start_time):
+        """Fetch unseen mail that arrived since monitoring started and forward any OTPs"""
         user_config = self.users[chat_id]
         user_email = user_config["email"]
+        uid_next = user_config["uid_next"]
         
-        self.logger.info(f"Started monitoring Gmail for {user_email} (Chat ID: {chat_id})")
+        status, messages = mail.uid("SEARCH", None, f"UID {uid_next}:* UNSEEN")
+        if status != "OK" or not messages[0]:
+            return
         
-        while user_config["is_monitoring"] and self.is_running:
-            try:
-                with self.gmail_locks[chat_id]:  # Per-user lock
-                    start_time = time.time()
+        # "n:*" always matches the newest message, even when its UID is below n
+        email_ids = [uid for uid in map(int, messages[0].split()) if uid >= uid_next]
+        
+        processed = user_config["last_processed_emails"]
+        
+        # Process newest emails first (last 5 for better coverage)
+        for email_id in email_ids[:-6:-1]:
+            if email_id in processed:
+                continue
+            
+            # Mark as processed immediately, evicting the oldest entry (memory management)
+            processed[email_id] = None
+            if len(processed) > PROCESSED_EMAILS_LIMIT:
+                processed.popitem(last=False)
+            
+            # BODY.PEEK leaves \Seen untouched so the user still sees the mail as unread
+            header_bytes = self.fetch_literal(mail, email_id, FETCH_HEADERS)
+            
+            if header_bytes is not None:
+                # Only the few fetched header fields are parsed up front
+                headers = MESSAGE_PARSER.parsebytes(header_bytes, headersonly=True)
+                
+                # Extract sender info
+                from_header = str(headers.get("From", "Unknown"))
+                from_match = FROM_RE.match(from_header)
+                if from_match:
+                    sender_name = from_match.group(1).strip().strip('"')
+                    sender_email = from_match.group(2)
+                else:
+                    sender_name = sender_email = from_header
+                
+                # Clean sender name
+                sender_name = sender_name.replace('"', '').strip() or sender_email.split('@')[0]
+                
+                # The default policy already decodes RFC 2047 encoded subjects
+                subject = str(headers.get("Subject", "No Subject"))
+                
+                # Extract OTP from subject first
+                otp = self.extract_otp(subject)
+                
+                # If not found, download and check the email body
+                if not otp:
+                    text_bytes = self.fetch_literal(mail, email_id, FETCH_TEXT) or b""
+                    email_message = MESSAGE_PARSER.parsebytes(header_bytes + text_bytes)
+                    otp = self.extract_otp(self.extract_text_body(email_message))
+                
+                if otp:
+                    # Calculate detection time
+                    detection_time = int((time.time() - start_time) * 1000)
+                    current_time = datetime.now().strftime("%H:%M:%S")
                     
-                    # Create individual IMAP connection
-                    mail = imaplib.IMAP4_SSL("imap.gmail.com")
-                    mail.login(user_config["email"], user_config["password"])
-                    mail.select("inbox")
+                    # Random message variations for natural feel
+                    message = OTP_MESSAGE_TEMPLATE.format(
+                        title=random.choice(TITLE_VARIATIONS),
+                        sender_name=sender_name,
+                        subject=subject,
+                        time=current_time,
+                        otp=otp,
+                        help=random.choice(HELP_VARIATIONS)
+                    )
                     
-                    # Quick inbox count check
-                    status, count_data = mail.status("inbox", "(MESSAGES)")
-                    if status == "OK":
-                        current_count = int(count_data[0].decode().split()[2].rstrip(')'))
-                        
-                        if current_count > user_config["last_email_count"]:
-                            user_config["last_email_count"] = current_count
-                            
-                            # Search for very recent unseen emails with date filter for speed
-                            today = datetime.now().strftime('%d-%b-%Y')
-                            status, messages = mail.search(None, f'(UNSEEN SINCE "{today}")')
-                            
-                            if status == "OK" and messages[0]:
-                                email_ids = messages[0].split()
-                                
-                                # Process newest emails first (last 5 for better coverage)
-                                for email_id in reversed(email_ids[-5:]):
-                                    email_id_str = email_id.decode()
-                                    
-                                    if email_id_str in user_config["last_processed_emails"]:
-                                        continue
-                                    
-                                    # Mark as processed immediately
-                                    user_config["last_processed_emails"].add(email_id_str)
-                                    
-                                    status, msg_data = mail.fetch(email_id, "(RFC822)")
-                                    
-                                    if status == "OK":
-                                        email_body = msg_data[0][1]
-                                        email_message = email.message_from_bytes(email_body)
-                                        
-                                        # Extract sender info
-                                        from_header = email_message.get("From", "Unknown")
-                                        sender_name = from_header.split('<')[0].strip().strip('"') if '<' in from_header else from_header
-                                        sender_email = from_header.split('<')[1].split('>')[0] if '<' in from_header else from_header
-                                        
-                                        # Clean sender name
-                                        sender_name = sender_name.replace('"', '').strip() or sender_email.split('@')[0]
-                                        
-                                        # Extract subject
-                                        subject = email_message.get("Subject", "No Subject")
-                                        if subject != "No Subject":
-                                            try:
-                                                decoded_subject = decode_header(subject)[0]
-                                                if decoded_subject[1]:
-                                                    subject = decoded_subject[0].decode(decoded_subject[1])
-                                                else:
-                                                    subject = str(decoded_subject[0])
-                                            except:
-                                                pass
-                                        
-                                        # Extract OTP from subject first
-                                        otp = self.extract_otp(subject)
-                                        
-                                        # If not found, check email body
-                                        if not otp:
-                                            body = ""
-                                            if email_message.is_multipart():
-                                                for part in email_message.walk():
-                                                    if part.get_content_type() == "text/plain":
-                                                        try:
-                                                            body = part.get_payload(decode=True).decode('utf-8')
-                                                            break
-                                                        except:
-                                                            continue
-                                            else:
-                                                try:
-                                                    body = email_message.get_payload(decode=True).decode('utf-8')
-                                                except:
-                                                    body = str(email_message.get_payload())
-                                            
-                                            otp = self.extract_otp(body)
-                                        
-                                        if otp:
-                                            # Calculate detection time
-                                            detection_time = int((time.time() - start_time) * 1000)
-                                            current_time = datetime.now().strftime("%H:%M:%S")
-                                            
-                                            # Random message variations for natural feel
-                                            import random
-                                            
-                                            title_variations = [
-                                                "🚀 New OTP Code!",
-                                                "⚡ Fresh OTP Code!",
-                                                "🔥 New Code Arrived!",
-                                                "✨ OTP Code Ready!",
-                                                "💫 New Verification Code!"
-                                            ]
-                                            
-                                            help_variations = [
-                                                "If you need help? contact me @Astro0_0o",
-                                                "Need assistance? reach me @Astro0_0o",
-                                                "Having issues? contact @Astro0_0o",
-                                                "For support contact @Astro0_0o",
-                                                "Questions? message @Astro0_0o",
-                                                "Need help? DM @Astro0_0o"
-                                            ]
-                                            
-                                            selected_title = random.choice(title_variations)
-                                            selected_help = random.choice(help_variations)
-                                            
-                                            # Clean and professional OTP message format with full bold formatting
-                                            message = f"""<b>{selected_title}</b>
-
-<b>📧 From: {sender_name}</b>
-<b>📝 Subject: {subject}</b>
-<b>⏰ Time: {current_time}</b>
-<b>🔢 Code:</b> <code>{otp}</code>
-
-<b><i>{selected_help}</i></b>"""
-                                            
-                                            # Send instantly
-                                            self.send_message(chat_id, message)
-                                            
-                                            # Log to database
-                                            self.log_otp(chat_id, sender_email, sender_name, otp, subject, detection_time)
-                                            
-                                            self.logger.info(f"OTP forwarded to {user_email}: {otp} ({detection_time}ms)")
-                                    
-                                    # Clean old processed emails (memory management)
-                                    if len(user_config["last_processed_emails"]) > 100:
-                                        old_emails = list(user_config["last_processed_emails"])[:50]
-                                        for old_email in old_emails:
-                                            user_config["last_processed_emails"].discard(old_email)
-                        
-                        elif user_config["last_email_count"] == 0:
-                            # Initialize count
-                            user_config["last_email_count"] = current_count
+                    # Send instantly
+                    self.send_message(chat_id, message)
                     
-                    mail.close()
-                    mail.logout()
+                    # Log to database
+                    self.log_otp(chat_id, sender_email, sender_name, otp, subject, detection_time)
                     
-            except Exception as e:
-                self.logger.error(f"Gmail monitoring error for {user_email}: {e}")
-                time.sleep(2)  # Error recovery delay
+                    self.logger.info(f"OTP forwarded to {user_email}: {otp} ({detection_time}ms)")
+    
+    def extract_text_body(self, email_message):
+        """Return the text/plain body, falling back to tag-stripped text/html"""
+        # get_body finds the preferred part directly and skips attachments
+        part = email_message.get_body(preferencelist=('plain', 'html'))
+        if part is None:
+            return ""
+        
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            return ""
+        
+        text = payload.decode('utf-8', 'ignore')
+        if part.get_content_subtype() == "html":
+            return HTML_NOISE_RE.sub(" ", text)
+        return text
+    
+    def fetch_literal(self, mail, email_id, query):
+        """UID FETCH a single body section and return its bytes"""
+        status, msg_data = mail.uid("FETCH", str(email_id), query)
+        if status == "OK":
+            for part in msg_data:
+                if isinstance(part, tuple):
+                    return part[1]
+        return None
+    
+    def open_gmail_session(self, chat_id, user_config):
+        """Connect a user's mailbox, forward anything missed and start idling"""
+        if not user_config["is_monitoring"] or not self.is_running:
+            return
+        
+        try:
+            user_config["mail"] = self.connect_gmail(user_config)
+            
+            # Catch anything that arrived while we were disconnected
+            self.process_new_emails(chat_id, user_config["mail"], time.time())
+            self.arm_idle(chat_id, user_config)
             
-            # Ultra-fast monitoring interval for instant OTP detection
-            time.sleep(0.2)  # Check every 200ms for lightning-fast detection
+        except Exception as e:
+            self.logger.error(f"Gmail monitoring error for {user_config['email']}: {e}")
+            self.drop_gmail_session(chat_id, user_config)
+    
+    def arm_idle(self, chat_id, user_config):
+        """Put the session into IDLE and hand its socket to the shared poller"""
+        mail = user_config["mail"]
+        user_config["idle_tag"] = self.start_idle(mail)
+        user_config["idle_since"] = time.time()
         
-        self.logger.info(f"Stopped monitoring Gmail for {user_email}")
+        # Data already buffered by the TLS layer or imaplib will not wake the selector. Peek
+        # before registering, so the poller never hands the session to a second thread mid-peek
+        if self.has_buffered_response(mail):
+            self.executor.submit(self.handle_idle_session, chat_id, user_config)
+            return
+        
+        self.idle_sessions[id(user_config)] = (chat_id, user_config)
+        self.idle_selector.register(mail.sock, selectors.EVENT_READ, (chat_id, user_config))
+    
+    def release_idle_session(self, chat_id, user_config):
+        """Take a session away from the poller and handle it on the executor"""
+        with self.idle_lock:
+            if self.idle_sessions.pop(id(user_config), None) is None:
+                return
+        
+        try:
+            self.idle_selector.unregister(user_config["mail"].sock)
+        except (KeyError, ValueError):
+            pass
+        
+        self.executor.submit(self.handle_idle_session, chat_id, user_config)
+    
+    def handle_idle_session(self, chat_id, user_config):
+        """Leave IDLE after server activity or a refresh, forward new OTPs, then re-arm"""
+        start_time = time.time()
+        try:
+            has_new_mail = self.stop_idle(user_config["mail"], user_config["idle_tag"])
+            
+            if not user_config["is_monitoring"] or not self.is_running:
+                user_config["mail"] = self.close_gmail(user_config["mail"])
+                return
+            
+            if has_new_mail:
+                self.process_new_emails(chat_id, user_config["mail"], start_time)
+            self.arm_idle(chat_id, user_config)
+            
+        except Exception as e:
+            # Dropped connection - reconnect after a short delay
+            self.logger.warning(f"Gmail connection lost for {user_config['email']}: {e}")
+            self.drop_gmail_session(chat_id, user_config)
+    
+    def drop_gmail_session(self, chat_id, user_config):
+        """Close a broken session and schedule a reconnect while monitoring is on"""
+        user_config["mail"] = self.close_gmail(user_config["mail"])
+        if user_config["is_monitoring"] and self.is_running:
+            self.reconnect_due[chat_id] = (time.time() + RECONNECT_DELAY, user_config)
+    
+    def idle_poller(self):
+        """Wait on every idling IMAP socket at once and dispatch activity to the executor"""
+        while self.is_running:
+            for key, _ in self.idle_selector.select(timeout=1):
+                self.release_idle_session(*key.data)
+            
+            now = time.time()
+            
+            # Re-IDLE every 25 minutes, before Gmail drops idle sessions, and close logged-out ones
+            for chat_id, user_config in list(self.idle_sessions.values()):
+                if not user_config["is_monitoring"] or now - user_config["idle_since"] > IDLE_TIMEOUT:
+                    self.release_idle_session(chat_id, user_config)
+            
+            for chat_id, (due, user_config) in list(self.reconnect_due.items()):
+                if due <= now:
+                    del self.reconnect_due[chat_id]
+                    self.executor.submit(self.open_gmail_session, chat_id, user_config)
+    
+    def close_gmail(self, mail):
+        """Best-effort logout of an IMAP session"""
+        if mail is not None:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+        return None
     
     def start_monitoring_for_user(self, chat_id):
         """Start Gmail monitoring for a specific user"""
@@ -491,21 +773,14 @@ class ProfessionalMultiUserOTPBot:
         
         user_config = self.users[chat_id]
         
-        if user_config["is_monitoring"]:
-            return True  # Already monitoring
-        
-        user_config["is_monitoring"] = True
-        
-        # Create dedicated thread for this user
-        monitor_thread = threading.Thread(
-            target=self.monitor_gmail_for_user,
-            args=(chat_id,),
-            daemon=True,
-            name=f"Gmail-Monitor-{chat_id}"
-        )
+        # Logins finish on worker threads, so two starts can race
+        with self.monitoring_lock:
+            if user_config["is_monitoring"]:
+                return True  # Already monitoring
+            
+            user_config["is_monitoring"] = True
         
-        monitor_thread.start()
-        self.monitoring_threads[chat_id] = monitor_thread
+        self.executor.submit(self.open_gmail_session, chat_id, user_config)
         
         self.logger.info(f"Started monitoring for user {chat_id} ({self.users[chat_id]['email']})")
         return True
@@ -513,49 +788,37 @@ class ProfessionalMultiUserOTPBot:
     def stop_monitoring_for_user(self, chat_id):
         """Stop Gmail monitoring for specific user"""
         if chat_id in self.users:
-            self.users[chat_id]["is_monitoring"] = False
-        
-        if chat_id in self.monitoring_threads:
-            # Thread will stop on next iteration
-            self.monitoring_threads[chat_id].join(timeout=2)
-            del self.monitoring_threads[chat_id]
+            user_config = self.users[chat_id]
+            user_config["is_monitoring"] = False
+            self.reconnect_due.pop(chat_id, None)
+            
+            # An idling session is closed by its handler once the poller releases it
+            self.release_idle_session(chat_id, user_config)
         
         self.logger.info(f"Stopped monitoring for user {chat_id}")
     
     def get_user_stats(self, chat_id):
         """Get detailed user statistics"""
         try:
-            conn = sqlite3.connect(os.path.join(CONFIG_DIR, DB_FILE))
-            cursor = conn.cursor()
-            
-            # Get user stats
-            cursor.execute("""
-                SELECT total_otps, created_at, last_active 
-                FROM users WHERE chat_id = ?
-            """, (chat_id,))
-            user_data = cursor.fetchone()
-            
-            if not user_data:
-                return None
-            
-            total_otps, created_at, last_active = user_data
-            
-            # Get today's OTPs
-            cursor.execute("""
-                SELECT COUNT(*) FROM otp_logs 
-                WHERE chat_id = ? AND DATE(forwarded_at) = DATE('now')
-            """, (chat_id,))
-            today_otps = cursor.fetchone()[0]
-            
-            # Get recent OTPs
-            cursor.execute("""
-                SELECT sender_name, otp_code, forwarded_at 
-                FROM otp_logs WHERE chat_id = ? 
-                ORDER BY forwarded_at DESC LIMIT 5
-            """, (chat_id,))
-            recent_otps = cursor.fetchall()
-            
-            conn.close()
+            with self.read_connection() as conn:
+                cursor = conn.cursor()
+                
+                # Get user stats
+                cursor.execute(SQL_USER_STATS, (chat_id,))
+                user_data = cursor.fetchone()
+                
+                if not user_data:
+                    return None
+                
+                total_otps, created_at, last_active = user_data
+                
+                # Get today's OTPs
+                cursor.execute(SQL_TODAY_OTPS, (chat_id,))
+                today_otps = cursor.fetchone()[0]
+                
+                # Get recent OTPs
+                cursor.execute(SQL_RECENT_OTPS, (chat_id,))
+                recent_otps = cursor.fetchall()
             
             return {
                 "total_otps": total_otps,
@@ -572,8 +835,12 @@ class ProfessionalMultiUserOTPBot:
     
     def handle_message(self, message):
         """Professional message handling with full command support"""
+        # Stickers, photos, joins etc. carry no command or input
+        if 'text' not in message:
+            return
+        
         chat_id = message['chat']['id']
-        text = message.get('text', '').strip()
+        text = message['text'].strip()
         user_info = message.get('from', {})
         
         # Command routing
@@ -625,6 +892,10 @@ Send <code>/login</code> to get started!
     
     def handle_login_command(self, chat_id):
         """Handle login command"""
+        if chat_id in self.login_tests:
+            self.send_message(chat_id, "⏳ <b>Still testing your last login.</b>\n\n<i>Please wait for the result.</i>")
+            return
+        
         if chat_id in self.users and self.users[chat_id]["is_monitoring"]:
             stats = self.get_user_stats(chat_id)
             if stats:
@@ -684,7 +955,7 @@ Use <code>/login</code> to connect again.""")
 
 📧 <b>Email:</b> {self.users[chat_id]['email']}
 🔄 <b>Monitoring:</b> ⚡ Ultra-Fast Mode
-⏱️ <b>Check Interval:</b> 200ms
+⏱️ <b>Check Mode:</b> Instant push (IMAP IDLE)
 🎯 <b>Detection Speed:</b> Under 1 second
 
 📊 <b>Statistics:</b>
@@ -753,7 +1024,7 @@ Use <code>/login</code> to connect and start monitoring!""")
 • 🔒 Secure credential handling with encryption
 • 📊 Comprehensive statistics & logging
 • 🎯 Smart OTP pattern recognition
-• 🔄 Automatic monitoring with 200ms intervals
+• 🔄 Automatic push monitoring via IMAP IDLE
 
 <b>🔐 Security:</b>
 • Passwords are encrypted before storage
@@ -813,19 +1084,30 @@ If you encounter any issues, use <code>/logout</code> then <code>/login</code> a
             # Test Gmail connection
             self.send_message(chat_id, "🔄 <b>Testing Gmail connection...</b>\n\n<i>Please wait...</i>")
             
-            try:
-                # Test IMAP connection
-                mail = imaplib.IMAP4_SSL("imap.gmail.com")
+            # Clear temporary data
+            self.waiting_states.pop(chat_id, None)
+            self.temp_credentials.pop(chat_id, None)
+            
+            # The TLS handshake and login take ~1s; keep them off the polling loop
+            self.login_tests.add(chat_id)
+            self.executor.submit(self.test_and_start_monitoring, chat_id, email, password, user_info)
+    
+    def test_and_start_monitoring(self, chat_id, email, password, user_info):
+        """Verify Gmail credentials, then save the user and start monitoring"""
+        try:
+            # Test IMAP connection
+            with self.login_slots:
+                mail = imaplib.IMAP4_SSL(IMAP_HOST, ssl_context=IMAP_SSL_CONTEXT, timeout=IMAP_TIMEOUT)
                 mail.login(email, password)
-                mail.select("inbox")
-                mail.close()
-                mail.logout()
-                
-                # Save user
-                if self.save_user(chat_id, email, password, user_info):
-                    # Start monitoring
-                    if self.start_monitoring_for_user(chat_id):
-                        success_msg = f"""✅ <b>Connected Successfully!</b>
+            mail.select("inbox")
+            mail.close()
+            mail.logout()
+            
+            # Save user
+            if self.save_user(chat_id, email, password, user_info):
+                # Start monitoring
+                if self.start_monitoring_for_user(chat_id):
+                    success_msg = f"""✅ <b>Connected Successfully!</b>
 
 📧 <b>Email:</b> <code>{email}</code>
 🚀 <b>Status:</b> Active Monitoring
@@ -834,15 +1116,15 @@ If you encounter any issues, use <code>/logout</code> then <code>/login</code> a
 🔄 <b>Bot is now monitoring your Gmail for OTPs!</b>
 
 <i>💡 Use <code>/status</code> to check your connection anytime</i>"""
-                        
-                        self.send_message(chat_id, success_msg)
-                    else:
-                        self.send_message(chat_id, "❌ Error starting monitoring. Please try <code>/login</code> again.")
+                    
+                    self.send_message(chat_id, success_msg)
                 else:
-                    self.send_message(chat_id, "❌ Error saving credentials. Please try <code>/login</code> again.")
-                
-            except Exception as e:
-                error_msg = f"""❌ <b>Connection Failed!</b>
+                    self.send_message(chat_id, "❌ Error starting monitoring. Please try <code>/login</code> again.")
+            else:
+                self.send_message(chat_id, "❌ Error saving credentials. Please try <code>/login</code> again.")
+            
+        except Exception as e:
+            error_msg = f"""❌ <b>Connection Failed!</b>
 
 <b>Possible issues:</b>
 • Incorrect App Password
@@ -856,18 +1138,18 @@ If you encounter any issues, use <code>/logout</code> then <code>/login</code> a
 3. Use App Password, not regular password
 
 <i>Use <code>/login</code> to try again</i>"""
-                
-                self.send_message(chat_id, error_msg)
-                self.logger.error(f"Gmail connection failed for {email}: {e}")
             
-            # Clear temporary data
-            self.waiting_states.pop(chat_id, None)
-            self.temp_credentials.pop(chat_id, None)
+            self.send_message(chat_id, error_msg)
+            self.logger.error(f"Gmail connection failed for {email}: {e}")
+        
+        self.login_tests.discard(chat_id)
     
     def run(self):
         """Main bot loop"""
         self.logger.info("Starting bot main loop...")
         
+        # Telegram serves getUpdates to one consumer per token; this loop is the only
+        # caller, so run exactly one instance of the bot per token
         while self.is_running:
             try:
                 updates = self.get_updates()
@@ -891,11 +1173,21 @@ If you encounter any issues, use <code>/logout</code> then <code>/login</code> a
         for chat_id in list(self.users.keys()):
             self.stop_monitoring_for_user(chat_id)
         
+        # Flush pending OTP logs
+        self.write_queue.join()
+        self.session.close()
+        
         self.logger.info("Bot stopped successfully")
 
 if __name__ == "__main__":
-    # Your bot token
-    BOT_TOKEN = "7778515412:AAEQT4emxwDm4JLeWSpwaABEe7gF8LWUGYY"
+    # Process-wide setting; applies to every thread started from here on
+    threading.stack_size(THREAD_STACK_SIZE)
+    
+    # Bot token from the environment, never from source
+    BOT_TOKEN = os.environ.get("BOT_TOKEN")
+    if not BOT_TOKEN:
+        print("❌ Set the BOT_TOKEN environment variable to your bot's token")
+        raise SystemExit(1)
     
     # Create and run bot
     bot = ProfessionalMultiUserOTPBot(BOT_TOKEN)
@@ -2,33 +2,106 @@
 #!/usr/bin/env python3
 
 import imaplib
-import email
 import re
 import time
 import json
 import os
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
 import threading
-from email.header import decode_header
+import queue
+import select
+import socket
+import ssl
+from bisect import bisect_right
+from email.header import decode_header, make_header
+from email.errors import HeaderParseError
+from email.utils import parseaddr
+from email.parser import BytesParser, BytesHeaderParser
+from email.policy import default as default_policy
+
+# orjson parses Telegram replies about twice as fast when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Configuration file path
 CONFIG_FILE = "bot_config.json"
 
+# Bot API endpoint. Point this at a self-hosted telegram-bot-api server (--local),
+# ideally in the same region as the bot, to cut the round trip of every send
+TG_API_BASE = os.environ.get("TG_API_BASE", "https://api.telegram.org").rstrip("/")
+
+# Seconds Telegram holds getUpdates open when there is nothing to deliver
+LONG_POLL_TIMEOUT = 50
+UPDATES_LIMIT = 20  # A single-user bot rarely has more than a few pending updates
+
+# Telegram send limits: ~30 messages/s overall and one per second per chat
+SEND_RATE_GLOBAL = 25
+SEND_INTERVAL_PER_CHAT = 1.0
+
+# OTP patterns: a keyword followed by a code (Code: 123456), or any 4-8 digit number
+OTP_SUBJECT_RE = re.compile(r'(?:code|verification|otp)[:\s-]*(\d{4,8})|\b(\d{4,8})\b', re.IGNORECASE)
+OTP_BODY_RE = re.compile(r'(?:code|verification|otp|pin)[:\s-]*(\d{4,8})|\b(\d{4,8})\b', re.IGNORECASE)
+# Markup stripped from HTML-only bodies: style/script blocks (even if truncated), tags and #hex colours
+HTML_NOISE_RE = re.compile(r'<(style|script)\b.*?(?:</\1\s*>|$)|<[^>]+>|#[0-9a-f]{3,8}\b', re.IGNORECASE | re.DOTALL)
+
+# IMAP settings
+IMAP_HOST = "imap.gmail.com"
+IDLE_TIMEOUT = 29 * 60  # Re-issue IDLE before Gmail's 30 minute limit
+IMAP_TIMEOUT = 30  # Seconds a blocking IMAP read may stall before the session is dropped
+RECONNECT_DELAY = 2  # First retry delay after a connection error, doubled up to the max
+MAX_RECONNECT_DELAY = 300
+POLL_INTERVAL = 2  # Fallback polling when the server lacks IDLE, stretched while quiet
+MAX_POLL_INTERVAL = 60
+POLL_BACKOFF = 1.5
+IDLE_EXISTS_RE = re.compile(rb'^\* \d+ EXISTS')
+UIDNEXT_RE = re.compile(rb'UIDNEXT (\d+)')
+FETCH_HEADERS = '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING)])'
+FETCH_TEXT = '(BODY.PEEK[TEXT]<0.4096>)'
+HEADER_PARSER = BytesHeaderParser()
+MESSAGE_PARSER = BytesParser(policy=default_policy)
+
 class GmailOTPBot:
     def __init__(self, bot_token):
         self.bot_token = bot_token
-        self.base_url = f"https://api.telegram.org/bot{bot_token}"
+        self.base_url = f"{TG_API_BASE}/bot{bot_token}"
+        
+        # Keep-alive connections to the Telegram API
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+        
         self.gmail_config = {}
         self.is_running = False
-        self.last_processed_emails = set()
+        self.monitor_thread = None
+        self.state_lock = threading.Lock()  # Serializes starting and stopping the monitor
+        self.last_seen_uid = 0
+        self.config_bytes = None  # Last serialized config, to skip unchanged writes
+        self.config_lock = threading.RLock()  # Serializes every read-modify-write of the config file
+        
+        # Outgoing messages are sent by one rate-limited worker
+        self.send_queue = queue.Queue()
+        self.send_tokens = SEND_RATE_GLOBAL
+        self.send_tokens_at = time.monotonic()
+        self.last_sent_at = {}
+        
+        # Login conversation state per chat
+        self.waiting_states = {}
+        self.temp_credentials = {}
         
     def load_config(self):
         """Load Gmail configuration from file"""
         if os.path.exists(CONFIG_FILE):
             try:
-                with open(CONFIG_FILE, 'r') as f:
-                    self.gmail_config = json.load(f)
+                with open(CONFIG_FILE, 'rb') as f:
+                    self.config_bytes = f.read()
+                self.gmail_config = json.loads(self.config_bytes)
+                if "email" not in self.gmail_config:
+                    self.gmail_config = {}
+                    return False
+                self.last_seen_uid = self.gmail_config.get("last_seen_uid", 0)
                 return True
             except:
                 return False
@@ -36,29 +109,84 @@ class GmailOTPBot:
     
     def save_config(self, email, password, chat_id):
         """Save Gmail configuration to file"""
-        self.gmail_config = {
-            "email": email,
-            "password": password,
-            "chat_id": chat_id
-        }
-        try:
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(self.gmail_config, f)
-            return True
-        except:
-            return False
+        with self.config_lock:
+            self.gmail_config = {
+                "email": email,
+                "password": password,
+                "chat_id": chat_id
+            }
+            # A new login starts from the mailbox's current UIDNEXT again
+            self.last_seen_uid = 0
+            return self.write_config()
+    
+    def write_config(self):
+        """Atomically write the current configuration to file if it changed"""
+        with self.config_lock:
+            try:
+                data = json.dumps(self.gmail_config).encode()
+                if data == self.config_bytes:
+                    return True
+                
+                # Write a temp file and rename it so a crash never leaves a truncated config
+                tmp_file = CONFIG_FILE + ".tmp"
+                with open(tmp_file, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_file, CONFIG_FILE)
+                self.config_bytes = data
+                return True
+            except:
+                return False
     
     def delete_config(self):
         """Delete configuration file"""
-        try:
-            if os.path.exists(CONFIG_FILE):
-                os.remove(CONFIG_FILE)
-            self.gmail_config = {}
-            return True
-        except:
-            return False
+        with self.config_lock:
+            try:
+                if os.path.exists(CONFIG_FILE):
+                    os.remove(CONFIG_FILE)
+                self.gmail_config = {}
+                self.config_bytes = None
+                self.last_seen_uid = 0
+                return True
+            except:
+                return False
     
     def send_message(self, chat_id, message, parse_mode="HTML"):
+        """Queue a message for the Telegram send worker"""
+        self.send_queue.put((chat_id, message, parse_mode))
+    
+    def wait_for_send_slot(self, chat_id):
+        """Block until both the global and the per-chat rate limits allow a send"""
+        while True:
+            now = time.monotonic()
+            self.send_tokens = min(SEND_RATE_GLOBAL, self.send_tokens + (now - self.send_tokens_at) * SEND_RATE_GLOBAL)
+            self.send_tokens_at = now
+            
+            chat_wait = self.last_sent_at.get(chat_id, 0) + SEND_INTERVAL_PER_CHAT - now
+            token_wait = (1 - self.send_tokens) / SEND_RATE_GLOBAL
+            wait = max(chat_wait, token_wait)
+            if wait <= 0:
+                self.send_tokens -= 1
+                self.last_sent_at[chat_id] = now
+                return
+            time.sleep(wait)
+    
+    def send_worker(self):
+        """Drain the send queue, honouring rate limits and 429 retry_after"""
+        while True:
+            chat_id, message, parse_mode = self.send_queue.get()
+            try:
+                while True:
+                    self.wait_for_send_slot(chat_id)
+                    result = self.post_message(chat_id, message, parse_mode)
+                    if not result or result.get("error_code") != 429:
+                        break
+                    retry_after = result.get("parameters", {}).get("retry_after", 1)
+                    print(f"Telegram rate limit hit, retrying in {retry_after}s")
+                    time.sleep(retry_after)
+            finally:
+                self.send_queue.task_done()
+    
+    def post_message(self, chat_id, message, parse_mode="HTML"):
         """Send message to Telegram"""
         try:
             url = f"{self.base_url}/sendMessage"
@@ -67,140 +195,251 @@ class GmailOTPBot:
                 "text": message,
                 "parse_mode": parse_mode
             }
-            response = requests.post(url, data=data, timeout=10)
-            return response.json()
+            response = self.session.post(url, data=data, timeout=10)
+            return json_loads(response.content)
         except Exception as e:
             print(f"Error sending message: {e}")
             return None
     
     def get_updates(self, offset=0):
-        """Get updates from Telegram"""
+        """Long-poll Telegram for new messages"""
         try:
             url = f"{self.base_url}/getUpdates"
-            params = {"offset": offset, "timeout": 10}
-            response = requests.get(url, params=params, timeout=15)
-            return response.json()
+            params = {
+                "offset": offset,
+                "timeout": LONG_POLL_TIMEOUT,
+                "limit": UPDATES_LIMIT,
+                "allowed_updates": json.dumps(["message"])
+            }
+            response = self.session.get(url, params=params, timeout=LONG_POLL_TIMEOUT + 5)
+            return json_loads(response.content)
         except Exception as e:
             print(f"Error getting updates: {e}")
             return None
     
-    def extract_otp_from_subject(self, subject):
-        """Extract OTP from email subject"""
-        patterns = [
-            r'\b\d{4,8}\b',  # 4-8 digit numbers
-            r'code[:\s-]*(\d{4,8})',  # Code: 123456
-            r'verification[:\s-]*(\d{4,8})',  # Verification: 123456
-            r'otp[:\s-]*(\d{4,8})',  # OTP: 123456
-        ]
+    def extract_otps_from_subjects(self, subjects):
+        """Extract OTPs from many subjects with one regex pass over a joined blob"""
+        otps = [None] * len(subjects)
+        starts = []
+        offset = 0
+        for subject in subjects:
+            starts.append(offset)
+            offset += len(subject) + 1
         
-        for pattern in patterns:
-            match = re.search(pattern, subject, re.IGNORECASE)
-            if match:
-                if len(match.groups()) > 0:
-                    return match.group(1)
-                else:
-                    return match.group(0)
-        return None
+        # NUL is neither a word nor a space character, so no match spans two subjects
+        blob = "\x00".join(subjects)
+        for match in OTP_SUBJECT_RE.finditer(blob):
+            index = bisect_right(starts, match.start()) - 1
+            if otps[index] is None:
+                otps[index] = match.group(1) or match.group(2)
+        return otps
     
     def extract_otp_from_body(self, body):
         """Extract OTP from email body"""
-        patterns = [
-            r'\b\d{4,8}\b',  # 4-8 digit numbers
-            r'code[:\s-]*(\d{4,8})',
-            r'verification[:\s-]*(\d{4,8})',
-            r'otp[:\s-]*(\d{4,8})',
-            r'pin[:\s-]*(\d{4,8})',
-        ]
+        match = OTP_BODY_RE.search(body)
+        return (match.group(1) or match.group(2)) if match else None
+    
+    def connect_gmail(self):
+        """Open a logged-in IMAP session with the inbox selected"""
+        mail = imaplib.IMAP4_SSL(IMAP_HOST, timeout=IMAP_TIMEOUT)
+        mail.login(self.gmail_config["email"], self.gmail_config["password"])
+        mail.select("inbox")
         
-        for pattern in patterns:
-            matches = re.findall(pattern, body, re.IGNORECASE)
-            if matches:
-                # Return the first numeric match that looks like an OTP
-                for match in matches:
-                    if isinstance(match, tuple):
-                        match = match[0] if match[0] else match[1]
-                    if 4 <= len(match) <= 8:
-                        return match
+        # Only mail arriving after monitoring first started is forwarded
+        if not self.last_seen_uid:
+            self.last_seen_uid = self.read_uid_next(mail) - 1
+        
+        return mail
+    
+    def read_uid_next(self, mail):
+        """Return the selected inbox's UIDNEXT, failing the connection if it cannot be read"""
+        # SELECT normally reports it as an untagged [UIDNEXT n] response code
+        _, uid_data = mail.response("UIDNEXT")
+        if uid_data and uid_data[0]:
+            return int(uid_data[0])
+        
+        status, status_data = mail.status("INBOX", "(UIDNEXT)")
+        match = UIDNEXT_RE.search(status_data[0]) if status == "OK" and status_data[0] else None
+        if match is None:
+            raise imaplib.IMAP4.error("server did not report UIDNEXT")
+        return int(match.group(1))
+    
+    def close_gmail(self, mail):
+        """Best-effort logout of an IMAP session"""
+        if mail is not None:
+            try:
+                mail.logout()
+            except:
+                pass
         return None
     
-    def check_gmail(self):
-        """Check Gmail for new OTP emails"""
-        if not self.gmail_config:
-            return
+    def has_buffered_response(self, mail):
+        """Whether a server line can be read without waiting on the socket"""
+        # imaplib reads through a buffered file, so a line that arrived in the same read as
+        # an earlier one never wakes select(); peek without blocking instead
+        timeout = mail.sock.gettimeout()
+        mail.sock.settimeout(0)
+        try:
+            return bool(mail.file.peek(1))
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        finally:
+            mail.sock.settimeout(timeout)
+    
+    def read_idle_line(self, mail):
+        """Read one IDLE response line, treating a silent server as a dropped connection"""
+        try:
+            return mail.readline()
+        except socket.timeout:
+            raise imaplib.IMAP4.abort(f"no response from server within {IMAP_TIMEOUT}s")
+    
+    def wait_for_new_mail(self, mail, timeout=IDLE_TIMEOUT):
+        """Wait in IMAP IDLE until Gmail pushes new mail or the timeout expires"""
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+        response = self.read_idle_line(mail)
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.abort(f"IDLE rejected: {response!r}")
         
+        has_new_mail = False
+        deadline = time.time() + timeout
+        while not has_new_mail and self.is_running:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            
+            # Wake up every second so /logout is noticed without a server push
+            if not self.has_buffered_response(mail):
+                readable, _, _ = select.select([mail.sock], [], [], min(remaining, 1))
+                if not readable:
+                    continue
+            
+            line = self.read_idle_line(mail)
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            if IDLE_EXISTS_RE.match(line):
+                has_new_mail = True
+        
+        # Leave IDLE and read everything up to the tagged completion
+        mail.send(b"DONE\r\n")
+        while True:
+            line = self.read_idle_line(mail)
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+            if line.startswith(tag):
+                return has_new_mail
+            if IDLE_EXISTS_RE.match(line):
+                has_new_mail = True
+    
+    def fetch_literal(self, mail, email_id, query):
+        """UID FETCH a single body section and return its bytes"""
+        status, msg_data = mail.uid("FETCH", str(email_id), query)
+        if status == "OK":
+            for part in msg_data:
+                if isinstance(part, tuple):
+                    return part[1]
+        return None
+    
+    def decode_mime_header(self, value):
+        """Decode RFC 2047 encoded words, skipping the work for plain values"""
+        if '=?' not in value:
+            return value
         try:
-            # Connect to Gmail IMAP
-            mail = imaplib.IMAP4_SSL("imap.gmail.com")
-            mail.login(self.gmail_config["email"], self.gmail_config["password"])
-            mail.select("inbox")
+            return str(make_header(decode_header(value)))
+        except (LookupError, UnicodeError, HeaderParseError):
+            # Malformed or unknown-charset words are shown as sent
+            return value
+    
+    def parse_mail_headers(self, header_bytes):
+        """Return the decoded sender name, sender address and subject of a mail"""
+        email_message = HEADER_PARSER.parsebytes(header_bytes)
+        
+        # Get sender
+        from_header = email_message["From"]
+        if from_header:
+            sender, sender_email = parseaddr(str(from_header))
+            sender = self.decode_mime_header(sender) or sender_email
+        else:
+            sender = "Unknown"
+            sender_email = "Unknown"
+        
+        # Get subject
+        subject = email_message["Subject"]
+        if subject:
+            subject = self.decode_mime_header(str(subject))
+        else:
+            subject = "No Subject"
+        
+        return sender, sender_email, subject
+    
+    def parse_mail_body(self, message_bytes):
+        """Return the text of a mail's plain part, or of its HTML part without markup"""
+        email_message = MESSAGE_PARSER.parsebytes(message_bytes)
+        
+        # get_body picks the text/plain part directly, skipping attachments
+        body = ""
+        body_part = email_message.get_body(preferencelist=('plain', 'html'))
+        if body_part is not None:
+            try:
+                body = body_part.get_content()
+            except:
+                body = str(body_part.get_payload())
             
-            # Search for recent emails (last 10 minutes)
-            status, messages = mail.search(None, 'UNSEEN')
+            # HTML-only mail: match against the text, not the markup
+            if body_part.get_content_subtype() == "html":
+                body = HTML_NOISE_RE.sub(" ", body)
+        
+        return body
+    
+    def check_gmail(self, mail):
+        """Check Gmail for new OTP emails; return True if any new mail was seen"""
+        if not self.gmail_config:
+            return False
+        
+        start_uid = self.last_seen_uid
+        
+        # Search for emails newer than the last one processed
+        status, messages = mail.uid("SEARCH", None, f"UID {self.last_seen_uid + 1}:*")
+        
+        if status == "OK" and messages[0]:
+            # The UID range already excludes everything seen, so process all of it, oldest first.
+            # "n:*" always matches the newest message, even when its UID is below n
+            email_ids = sorted(uid for uid in map(int, messages[0].split()) if uid > self.last_seen_uid)
             
-            if status == "OK" and messages[0]:
-                email_ids = messages[0].split()
+            # Read the headers of every new mail first; PEEK keeps them unread
+            new_mails = []
+            for email_id in email_ids:
+                header_bytes = self.fetch_literal(mail, email_id, FETCH_HEADERS)
+                if header_bytes is None:
+                    continue
                 
-                for email_id in email_ids[-10:]:  # Check last 10 emails
-                    if email_id.decode() in self.last_processed_emails:
-                        continue
-                    
-                    # Fetch email
-                    status, msg_data = mail.fetch(email_id, "(RFC822)")
+                # One unparsable mail must not block every mail after it
+                try:
+                    sender, sender_email, subject = self.parse_mail_headers(header_bytes)
+                except Exception as e:
+                    print(f"Skipping unreadable mail {email_id}: {e}")
+                    continue
+                
+                new_mails.append((email_id, header_bytes, sender, sender_email, subject))
+            
+            # Most OTP senders put the code in the subject; match them all in one pass
+            otps = self.extract_otps_from_subjects([new_mail[4] for new_mail in new_mails])
+            
+            for (email_id, header_bytes, sender, sender_email, subject), otp in zip(new_mails, otps):
+                # Only then download the start of the text and parse the body
+                if not otp:
+                    text_bytes = self.fetch_literal(mail, email_id, FETCH_TEXT) or b""
+                    try:
+                        otp = self.extract_otp_from_body(self.parse_mail_body(header_bytes + text_bytes))
+                    except Exception as e:
+                        print(f"Skipping unreadable body of mail {email_id}: {e}")
+                
+                if otp:
+                    # Get current time
+                    current_time = datetime.now().strftime("%H:%M:%S")
                     
-                    if status == "OK":
-                        email_body = msg_data[0][1]
-                        email_message = email.message_from_bytes(email_body)
-                        
-                        # Get sender
-                        from_header = email_message["From"]
-                        if from_header:
-                            sender = from_header.split('<')[0].strip().strip('"')
-                            if '<' in from_header:
-                                sender_email = from_header.split('<')[1].split('>')[0]
-                            else:
-                                sender_email = from_header
-                        else:
-                            sender = "Unknown"
-                            sender_email = "Unknown"
-                        
-                        # Get subject
-                        subject = email_message["Subject"]
-                        if subject:
-                            decoded_subject = decode_header(subject)[0]
-                            if decoded_subject[1]:
-                                subject = decoded_subject[0].decode(decoded_subject[1])
-                            else:
-                                subject = str(decoded_subject[0])
-                        else:
-                            subject = "No Subject"
-                        
-                        # Get email body
-                        body = ""
-                        if email_message.is_multipart():
-                            for part in email_message.walk():
-                                if part.get_content_type() == "text/plain":
-                                    try:
-                                        body = part.get_payload(decode=True).decode('utf-8')
-                                        break
-                                    except:
-                                        continue
-                        else:
-                            try:
-                                body = email_message.get_payload(decode=True).decode('utf-8')
-                            except:
-                                body = str(email_message.get_payload())
-                        
-                        # Extract OTP
-                        otp = self.extract_otp_from_subject(subject)
-                        if not otp:
-                            otp = self.extract_otp_from_body(body)
-                        
-                        if otp:
-                            # Get current time
-                            current_time = datetime.now().strftime("%H:%M:%S")
-                            
-                            # Format message
-                            message = f"""🚀 <b>New OTP arrived!</b>
+                    # Format message
+                    message = f"""🚀 <b>New OTP arrived!</b>
 
 📧 <b>From:</b> {sender}
 📝 <b>Subject:</b> {subject}
@@ -208,37 +447,103 @@ class GmailOTPBot:
 🔢 <b>Code:</b> <code>{otp}</code>
 
 📬 <b>Sender Email:</b> {sender_email}"""
-                            
-                            # Send to Telegram
-                            self.send_message(self.gmail_config["chat_id"], message)
-                            print(f"OTP sent: {otp} from {sender}")
-                        
-                        # Mark as processed
-                        self.last_processed_emails.add(email_id.decode())
-            
-            mail.close()
-            mail.logout()
+                    
+                    # Send to Telegram
+                    self.send_message(self.gmail_config["chat_id"], message)
+                    print(f"OTP sent: {otp} from {sender}")
+                
+                # Mark as processed as we go, so a dropped connection resumes after this mail
+                self.last_seen_uid = max(self.last_seen_uid, email_id)
             
-        except Exception as e:
-            print(f"Error checking Gmail: {e}")
-            if self.gmail_config.get("chat_id"):
-                self.send_message(self.gmail_config["chat_id"], f"❌ Gmail check error: {str(e)}")
+            # Mails without headers or with unreadable ones are not retried
+            if email_ids:
+                self.last_seen_uid = max(email_ids)
+        
+        # Persist progress so a restart does not re-scan or skip mail, but never
+        # write back a config that /logout deleted while this check was running
+        with self.config_lock:
+            if self.is_running and "email" in self.gmail_config and self.gmail_config.get("last_seen_uid") != self.last_seen_uid:
+                self.gmail_config["last_seen_uid"] = self.last_seen_uid
+                self.write_config()
+        
+        return self.last_seen_uid > start_uid
+    
+    def sleep_while_running(self, seconds):
+        """Sleep up to the given time, waking early once monitoring stops"""
+        deadline = time.time() + seconds
+        while self.is_running and time.time() < deadline:
+            time.sleep(min(1, deadline - time.time()))
     
     def monitor_gmail(self):
-        """Monitor Gmail continuously"""
+        """Monitor Gmail continuously over one persistent IDLE session"""
         print("Starting Gmail monitoring...")
+        mail = None
+        delay = RECONNECT_DELAY
+        interval = POLL_INTERVAL
         while self.is_running:
             try:
-                self.check_gmail()
-                time.sleep(5)  # Check every 5 seconds
+                if mail is None:
+                    mail = self.connect_gmail()
+                    delay = RECONNECT_DELAY
+                    
+                    # Catch anything that arrived while we were disconnected
+                    self.check_gmail(mail)
+                
+                if "IDLE" in mail.capabilities:
+                    if self.wait_for_new_mail(mail):
+                        self.check_gmail(mail)
+                else:
+                    # No push support: poll, backing off while the mailbox is quiet
+                    self.sleep_while_running(interval)
+                    # NOOP lets the server report new mail and proves the session is alive
+                    mail.noop()
+                    if self.check_gmail(mail):
+                        interval = POLL_INTERVAL
+                    else:
+                        interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+                    
             except Exception as e:
-                print(f"Monitor error: {e}")
-                time.sleep(10)
+                print(f"Error checking Gmail: {e}")
+                # Only report the first failure of a streak, not every retry
+                if delay == RECONNECT_DELAY and self.gmail_config.get("chat_id"):
+                    self.send_message(self.gmail_config["chat_id"], f"❌ Gmail check error: {str(e)}")
+                mail = self.close_gmail(mail)
+                self.sleep_while_running(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        
+        self.close_gmail(mail)
+    
+    def start_monitoring(self):
+        """Start the Gmail monitor thread unless one is already running"""
+        with self.state_lock:
+            if self.is_running and self.monitor_thread is not None and self.monitor_thread.is_alive():
+                return False
+            
+            # A stopped monitor exits within about a second; never let two overlap
+            if self.monitor_thread is not None:
+                self.monitor_thread.join()
+            
+            self.is_running = True
+            self.monitor_thread = threading.Thread(target=self.monitor_gmail, daemon=True)
+            self.monitor_thread.start()
+            return True
+    
+    def stop_monitoring(self, wait=False):
+        """Signal the Gmail monitor thread to stop, optionally waiting until it has exited"""
+        with self.state_lock:
+            self.is_running = False
+            thread = self.monitor_thread
+        
+        if wait and thread is not None:
+            thread.join()
     
     def handle_message(self, message):
         """Handle incoming Telegram messages"""
+        if 'text' not in message:
+            return
+        
         chat_id = message['chat']['id']
-        text = message.get('text', '').strip()
+        text = message['text'].strip()
         
         if text == '/start':
             welcome_msg = """🤖 <b>Gmail OTP Bot</b>
@@ -259,11 +564,11 @@ Send /login to start monitoring your Gmail for OTP codes!"""
             
             self.send_message(chat_id, "📧 Please send your Gmail address:")
             # Wait for email
-            self.waiting_for_email = chat_id
+            self.waiting_states[chat_id] = 'email'
             
         elif text == '/logout':
             if self.gmail_config:
-                self.is_running = False
+                self.stop_monitoring()
                 self.delete_config()
                 self.send_message(chat_id, "✅ Logged out successfully!")
             else:
@@ -275,57 +580,50 @@ Send /login to start monitoring your Gmail for OTP codes!"""
 
 📧 <b>Email:</b> {self.gmail_config.get('email', 'Unknown')}
 🔄 <b>Monitoring:</b> Running
-⏰ <b>Check Interval:</b> 5 seconds
+⏰ <b>Check Mode:</b> Instant push (IMAP IDLE)
 
 Bot is monitoring your Gmail for OTP codes!"""
                 self.send_message(chat_id, status_msg)
             else:
                 self.send_message(chat_id, "❌ <b>Status: Inactive</b>\n\nUse /login to start monitoring!")
         
-        elif hasattr(self, 'waiting_for_email') and self.waiting_for_email == chat_id:
+        elif self.waiting_states.get(chat_id) == 'email':
             # Received email
             if '@gmail.com' in text:
-                self.temp_email = text
+                self.temp_credentials[chat_id] = {"email": text}
                 self.send_message(chat_id, "🔑 Please send your Gmail app password:")
-                self.waiting_for_password = chat_id
-                delattr(self, 'waiting_for_email')
+                self.waiting_states[chat_id] = 'password'
             else:
                 self.send_message(chat_id, "❌ Please send a valid Gmail address!")
                 
-        elif hasattr(self, 'waiting_for_password') and self.waiting_for_password == chat_id:
+        elif self.waiting_states.get(chat_id) == 'password':
             # Received password
             password = text.replace(' ', '')  # Remove spaces
+            email = self.temp_credentials.pop(chat_id)["email"]
+            del self.waiting_states[chat_id]
             
             # Test login
             try:
-                mail = imaplib.IMAP4_SSL("imap.gmail.com")
-                mail.login(self.temp_email, password)
+                mail = imaplib.IMAP4_SSL(IMAP_HOST, timeout=IMAP_TIMEOUT)
+                mail.login(email, password)
                 mail.logout()
                 
-                # Save config and start monitoring
-                self.save_config(self.temp_email, password, chat_id)
-                self.is_running = True
-                
-                # Start monitoring thread
-                monitor_thread = threading.Thread(target=self.monitor_gmail, daemon=True)
-                monitor_thread.start()
+                # The old monitor must be gone before the config and UID baseline change
+                self.stop_monitoring(wait=True)
+                self.save_config(email, password, chat_id)
+                self.start_monitoring()
                 
                 success_msg = f"""✅ <b>Login Successful!</b>
 
-📧 <b>Email:</b> {self.temp_email}
+📧 <b>Email:</b> {email}
 🔄 <b>Status:</b> Monitoring started
-⏰ <b>Check Interval:</b> 5 seconds
+⏰ <b>Check Mode:</b> Instant push (IMAP IDLE)
 
 Bot will now forward all OTP codes from your Gmail instantly!"""
                 self.send_message(chat_id, success_msg)
                 
-                delattr(self, 'waiting_for_password')
-                delattr(self, 'temp_email')
-                
             except Exception as e:
                 self.send_message(chat_id, f"❌ Login failed! Error: {str(e)}\n\nPlease check your credentials and try again with /login")
-                delattr(self, 'waiting_for_password')
-                delattr(self, 'temp_email')
         
         else:
             self.send_message(chat_id, "❓ Unknown command! Use /start to see available commands.")
@@ -333,14 +631,14 @@ Bot will now forward all OTP codes from your Gmail instantly!"""
     def run(self):
         """Run the bot"""
         print("Starting Telegram OTP Bot...")
+        threading.Thread(target=self.send_worker, daemon=True).start()
         
         # Load existing config
         if self.load_config():
-            self.is_running = True
-            monitor_thread = threading.Thread(target=self.monitor_gmail, daemon=True)
-            monitor_thread.start()
+            self.start_monitoring()
             print(f"Resumed monitoring for: {self.gmail_config['email']}")
         
+        # Telegram serves getUpdates to one consumer per token; run a single instance
         offset = 0
         
         while True:
@@ -353,20 +651,25 @@ Bot will now forward all OTP codes from your Gmail instantly!"""
                         
                         if "message" in update:
                             self.handle_message(update["message"])
-                
-                time.sleep(1)
+                else:
+                    # Back off while Telegram is unreachable instead of spinning
+                    time.sleep(5)
                 
             except KeyboardInterrupt:
                 print("\nBot stopped by user")
-                self.is_running = False
+                self.stop_monitoring()
+                self.session.close()
                 break
             except Exception as e:
                 print(f"Bot error: {e}")
                 time.sleep(5)
 
 if __name__ == "__main__":
-    # Your bot token
-    BOT_TOKEN = "7778515412:AAEQT4emxwDm4JLeWSpwaABEe7gF8LWUGYY"
+    # Bot token from the environment, never from source
+    BOT_TOKEN = os.environ.get("BOT_TOKEN")
+    if not BOT_TOKEN:
+        print("❌ Set the BOT_TOKEN environment variable to your bot's token")
+        raise SystemExit(1)
     
     # Create and run bot
     bot = GmailOTPBot(BOT_TOKEN)